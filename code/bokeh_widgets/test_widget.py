@@ -1,9 +1,10 @@
+import functools
 import logging
+import traceback
 from collections import Counter
 
 import numpy as np
 import mne
-from sklearn.metrics import balanced_accuracy_score, cohen_kappa_score
 from bokeh.io import curdoc
 from bokeh.plotting import figure
 from bokeh.models import Div, Select, Button, Slider
@@ -12,8 +13,35 @@ from bokeh.layouts import row, column
 
 from config import main_config, test_config
 from src.vhdr_formatter import load_vhdr
-from src.models import predict
+from src.models import make_predict_fn
+from src.preprocessing import epoching, get_preprocessing_sos
 from src.pipeline import load_pipeline
+from .utils import cached_property, invalidate_cached_properties
+
+
+@functools.lru_cache(maxsize=4)
+def load_run(run_path, prefilt):
+    """Load a game run (cached, recorded runs do not change on disk).
+
+    Arguments:
+        run_path {Path} -- Path of the .vhdr run
+        prefilt {bool} -- Apply prefiltering when loading
+
+    Returns:
+        np.array, np.array, np.array, float, List[str] -- float32 signal of
+        shape (n_channels, n_samples), timestamps, MNE events, sampling
+        frequency and channel names
+    """
+    raw = load_vhdr(run_path, resample=False, preprocess=prefilt,
+                    remove_ch=['Fp1', 'Fp2'])
+    events = mne.events_from_annotations(raw, verbose=False)[0]
+    values, ts = raw.get_data(return_times=True)
+    values = values.astype(np.float32, copy=False)
+
+    # Shared between calls, must not be modified
+    for array in [values, ts, events]:
+        array.flags.writeable = False
+    return values, ts, events, raw.info['sfreq'], raw.ch_names
 
 
 class TestWidget:
@@ -23,13 +51,17 @@ class TestWidget:
         self.pred_decoding = main_config['pred_decoding']
         self.decoding2pred = {v: k for k, v in self.pred_decoding.items()}
         self._data = {}
-        self.chrono_source = ColumnDataSource(dict(ts=[], y_true=[],
-                                                   y_pred=[]))
+        self.chrono_source = ColumnDataSource(self.empty_chrono_data)
+        self.confusion_matrix = np.zeros((len(self.pred_decoding),
+                                          len(self.pred_decoding)),
+                                         dtype=np.int64)
 
         # Model
         self.models_path = main_config['models_path']
         self.n_crops = test_config['n_crops']
         self.crop_len = test_config['crop_len']
+        self.chunk_size = test_config['chunk_size']
+        self._validation = None
 
     @property
     def available_pilots(self):
@@ -40,7 +72,7 @@ class TestWidget:
     def selected_pilot(self):
         return self.select_pilot.value
 
-    @property
+    @cached_property
     def available_sessions(self):
         if self.select_pilot != '':
             pilot_path = self.data_path / self.selected_pilot
@@ -52,7 +84,7 @@ class TestWidget:
         if self.selected_pilot != '':
             return self.data_path / self.selected_pilot / self.select_session.value
 
-    @property
+    @cached_property
     def available_runs(self):
         if self.select_session.value != '':
             runs = self.session_path.glob('game/*.vhdr')
@@ -67,15 +99,15 @@ class TestWidget:
         active = self.checkbox_preproc.active
         return [self.checkbox_preproc.labels[i] for i in active]
 
-    @property
+    @cached_property
     def should_reref(self):
         return 'Rereference' in self.selected_preproc
 
-    @property
+    @cached_property
     def should_filter(self):
         return 'Filter' in self.selected_preproc
 
-    @property
+    @cached_property
     def should_standardize(self):
         return 'Standardize' in self.selected_preproc
 
@@ -84,7 +116,7 @@ class TestWidget:
         active = self.checkbox_settings.active
         return [self.checkbox_settings.labels[i] for i in active]
 
-    @property
+    @cached_property
     def available_models(self):
         ml_models = [p.name for p in self.models_path.glob('*.pkl')]
         dl_models = [p.name for p in self.models_path.glob('*.h5')]
@@ -94,34 +126,49 @@ class TestWidget:
     def model_path(self):
         return self.models_path / self.select_model.value
 
-    @property
+    @cached_property
     def is_convnet(self):
         return self.select_model.value.split('.')[-1] == 'h5'
 
-    @property
+    @cached_property
     def win_len(self):
         return int(self.fs*self.slider_win_len.value)
 
+    @property
+    def empty_chrono_data(self):
+        return dict(ts=np.array([], dtype=np.float64),
+                    y_true=np.array([], dtype=np.int32),
+                    y_pred=np.array([], dtype=np.int32))
+
     @property
     def accuracy(self):
-        y_pred = self.chrono_source.data['y_pred']
-        y_true = self.chrono_source.data['y_true']
-        return balanced_accuracy_score(y_true, y_pred)
+        # Balanced accuracy: mean recall over groundtruth classes
+        support = self.confusion_matrix.sum(axis=1)
+        recalls = np.diag(self.confusion_matrix)[support > 0] / \
+            support[support > 0]
+        return np.mean(recalls)
 
     @property
     def kappa(self):
-        y_pred = self.chrono_source.data['y_pred']
-        y_true = self.chrono_source.data['y_true']
-        return cohen_kappa_score(y_true, y_pred)
+        # Cohen's kappa from observed (po) and chance (pe) agreements
+        n_preds = self.confusion_matrix.sum()
+        po = np.trace(self.confusion_matrix) / n_preds
+        pe = np.sum(self.confusion_matrix.sum(axis=0) *
+                    self.confusion_matrix.sum(axis=1)) / n_preds**2
+        return (po - pe) / (1 - pe)
 
     def on_pilot_change(self, attr, old, new):
         logging.info(f'Select pilot {new}')
+        invalidate_cached_properties(self, 'available_sessions',
+                                     'available_runs', 'available_models')
         self.select_session.value = ''
         self.select_run.value = ''
         self.update_widget()
 
     def on_session_change(self, attr, old, new):
         logging.info(f'Select session {new}')
+        invalidate_cached_properties(self, 'available_runs',
+                                     'available_models')
         self.select_run.value = ''
         self.update_widget()
 
@@ -130,36 +177,31 @@ class TestWidget:
             return
 
         logging.info(f'Select run {new}')
+        invalidate_cached_properties(self, 'available_models')
         self.update_widget()
 
-        raw = load_vhdr(self.run_path,
-                        resample=False,
-                        preprocess=test_config['prefilt'],
-                        remove_ch=['Fp1', 'Fp2'])
-        self.fs = raw.info['sfreq']
+        values, ts, events, self.fs, available_channels = load_run(
+            self.run_path, test_config['prefilt'])
+        invalidate_cached_properties(self, 'win_len')
+        self.sos = get_preprocessing_sos(self.fs)
 
         # Get channels
-        available_channels = raw.ch_names
         self.channel2idx = {c: i + 1 for i, c in enumerate(available_channels)}
 
-        # Get events & decode
-        events = mne.events_from_annotations(raw, verbose=False)[0]
-        decoded_events = []
-
-        for ts, _, marker in events:
-            raw_label = str(marker)
-            if len(raw_label) == 2:
-                label = int(raw_label[0])
-                if label in self.markers_decoding.keys():
-                    decoded_events.append([ts, label])
+        # Decode events (label is the first digit of 2-digit markers)
+        markers = events[:, 2]
+        labels = markers // 10
+        is_decoded = (markers >= 10) & (markers < 100) & \
+            np.isin(labels, list(self.markers_decoding.keys()))
+        decoded_events = np.column_stack([events[is_decoded, 0],
+                                          labels[is_decoded]])
 
         # Store signal and events
-        self._data['values'], self._data['ts'] = raw.get_data(
-            return_times=True)
-        self._data['events'] = [(ts/self.fs, action)
-                                for ts, action in decoded_events]
+        self._data['values'], self._data['ts'] = values, ts
+        self._data['events'] = decoded_events.astype(np.float64)
+        self._data['events'][:, 0] /= self.fs
 
-        counter = Counter([e[-1] for e in decoded_events])
+        counter = Counter(decoded_events[:, 1])
         logging.info(counter)
         self.div_info.text = f'<b>Frequency</b>: {self.fs} Hz<br>'
         for label, count in counter.items():
@@ -167,6 +209,7 @@ class TestWidget:
 
     def on_model_change(self, attr, old, new):
         logging.info(f'Select model {new}')
+        invalidate_cached_properties(self, 'available_models', 'is_convnet')
         self.select_model.options = self.available_models
         if new != '':
             if 'Ensemble' in self.selected_settings:
@@ -178,39 +221,109 @@ class TestWidget:
             else:
                 self.pipeline = load_pipeline(self.model_path)
 
+    def on_preproc_change(self, attr, old, new):
+        invalidate_cached_properties(self, 'should_reref', 'should_filter',
+                                     'should_standardize')
+
+    def on_win_len_change(self, attr, old, new):
+        invalidate_cached_properties(self, 'win_len')
+
     def update_widget(self):
         self.select_session.options = self.available_sessions
         self.select_run.options = self.available_runs
         self.select_model.options = self.available_models
         self.button_validate.label = 'Validate'
         self.button_validate.button_type = 'primary'
-        self.chrono_source.data = dict(ts=[], y_true=[], y_pred=[])
+        self.button_validate.disabled = False
+        self.chrono_source.data = self.empty_chrono_data
+        self.confusion_matrix[:] = 0
+
+        # Cancel any ongoing validation
+        self._validation = None
 
     def on_validate_start(self):
         assert self.select_run.value != '', 'Select a run first !'
         assert self.select_model.value != '', 'Select a model first !'
         self.update_widget()
+
+        events = self._data['events']
+        if len(events) == 0:
+            logging.info('No events to validate in this run')
+            self.button_validate.label = 'No events'
+            self.button_validate.button_type = 'danger'
+            return
+
+        # Locate the end sample of each event
+        ts_arr = self._data['ts']
+        ts_events = events[:, 0]
+        end_idx = np.searchsorted(ts_arr, ts_events)
+
+        # Keep the nearest sample (timestamps are sorted)
+        end_idx = np.clip(end_idx, 1, len(ts_arr) - 1)
+        prev_is_nearer = ts_events - ts_arr[end_idx - 1] <= \
+            ts_arr[end_idx] - ts_events
+        end_idx = end_idx - prev_is_nearer
+
+        y_trues = np.array([self.decoding2pred[self.markers_decoding[groundtruth]]
+                            for groundtruth in events[:, 1].astype(int)],
+                           dtype=np.int32)
+
+        # Signal and settings are frozen for all chunks of the validation
+        predict_fn = make_predict_fn(self.pipeline, self.is_convnet,
+                                     self._data['values'].shape[0],
+                                     self.n_crops, self.crop_len,
+                                     self.fs, self.should_reref,
+                                     self.should_filter,
+                                     self.should_standardize,
+                                     reduce_per_trial=True,
+                                     sos=self.sos)
+        self._validation = dict(values=self._data['values'],
+                                win_len=self.win_len, predict_fn=predict_fn,
+                                ts=ts_events, end_idx=end_idx,
+                                y_true=y_trues, next_idx=0)
+
         self.button_validate.label = 'Validating...'
         self.button_validate.button_type = 'warning'
-        curdoc().add_next_tick_callback(self.on_validate)
-
-    def on_validate(self):
-        for ts, groundtruth in self._data['events']:
-            # Extract epoch data
-            end_idx = np.argmin(abs(ts - self._data['ts']))
-            start_idx = end_idx - self.win_len
-            epoch = self._data['values'][np.newaxis, :, start_idx:end_idx]
-
-            # Predict
-            y_pred = predict(epoch, self.pipeline, self.is_convnet,
-                             self.n_crops, self.crop_len, self.fs,
-                             self.should_reref, self.should_filter,
-                             self.should_standardize)
-
-            y_true = self.decoding2pred[self.markers_decoding[groundtruth]]
-            self.chrono_source.stream(dict(ts=[ts],
-                                           y_true=[y_true],
-                                           y_pred=[y_pred]))
+        self.button_validate.disabled = True
+        curdoc().add_next_tick_callback(
+            functools.partial(self.on_validate, self._validation))
+
+    def on_validate(self, validation):
+        # Validation was cancelled or restarted since this chunk was scheduled
+        if validation is not self._validation:
+            return
+
+        chunk = slice(validation['next_idx'],
+                      validation['next_idx'] + self.chunk_size)
+        validation['next_idx'] = chunk.stop
+
+        try:
+            # Predict the epochs of the current chunk at once
+            epochs = epoching(validation['values'],
+                              validation['end_idx'][chunk],
+                              validation['win_len'])
+            y_preds = validation['predict_fn'](epochs).astype(np.int32)
+
+            # Update chronogram source with the whole chunk
+            y_trues = validation['y_true'][chunk]
+            self.chrono_source.stream(dict(ts=validation['ts'][chunk],
+                                           y_true=y_trues,
+                                           y_pred=y_preds))
+            np.add.at(self.confusion_matrix, (y_trues, y_preds), 1)
+        except Exception:
+            logging.info(f'Failed to validate - {traceback.format_exc()}')
+            self._validation = None
+            self.button_validate.label = 'Failed'
+            self.button_validate.button_type = 'danger'
+            self.button_validate.disabled = False
+            return
+
+        # Yield to the UI before the next chunk
+        if chunk.stop < len(validation['ts']):
+            curdoc().add_next_tick_callback(
+                functools.partial(self.on_validate, validation))
+            return
+        self._validation = None
 
         # Printing metrics
         self.div_info.text += f'<b>Accuracy:</b> {self.accuracy:.2f} <br>'
@@ -220,6 +333,7 @@ class TestWidget:
 
         self.button_validate.label = 'Finished'
         self.button_validate.button_type = 'success'
+        self.button_validate.disabled = False
 
     def create_widget(self):
         # Select - Pilot
@@ -245,9 +359,11 @@ class TestWidget:
         self.checkbox_preproc = CheckboxButtonGroup(labels=['Filter',
                                                             'Standardize',
                                                             'Rereference'])
+        self.checkbox_preproc.on_change('active', self.on_preproc_change)
 
         self.slider_win_len = Slider(start=0.5, end=4, value=1,
                                      step=0.25, title='Win len (s)')
+        self.slider_win_len.on_change('value', self.on_win_len_change)
 
         self.checkbox_settings = CheckboxButtonGroup(labels=['Ensemble'])
 
@@ -7,3 +7,24 @@ def clean_log_directory(path_to_clean):
 
     if not os.path.exists(path_to_clean):
         os.mkdir(path_to_clean)
+
+
+class cached_property:
+    """Property computed once and stored on the instance
+    (backport of functools.cached_property, Python >= 3.8)."""
+
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
+
+def invalidate_cached_properties(obj, *names):
+    for name in names:
+        obj.__dict__.pop(name, None)
@@ -25,6 +25,7 @@ test_config = {
     'prefilt': False,
     'n_crops': 10,
     'crop_len': 0.5,
+    'chunk_size': 64,   # events predicted between two UI updates
     'markers_decoding': {2: 'Rest', 4: 'Left', 6: 'Right', 8: 'Headlight'}
 }
 
@@ -8,7 +8,8 @@ import mne
 
 from config import main_config, predictor_config, game_config
 from src.pipeline import load_pipeline
-from src.models import predict
+from src.models import make_predict_fn
+from src.preprocessing import get_preprocessing_sos
 from src.game_player import GamePlayer
 
 
@@ -35,6 +36,7 @@ class ActionPredictor(QtCore.QRunnable):
         self.apply_filt = predictor_config['apply_filt']
         self.f_min = predictor_config['f_min']
         self.f_max = predictor_config['f_max']
+        self.sos = get_preprocessing_sos(self.fs)
 
         # Prediction
         self.predict_every_s = predictor_config['predict_every_s']
@@ -50,6 +52,7 @@ class ActionPredictor(QtCore.QRunnable):
             self.model = 'AUTOPLAY'
         else:
             self.model = load_pipeline(modelfile)
+        self.predict_fn = None
 
         # Game player
         self.player_idx = game_config['player_idx']
@@ -102,10 +105,17 @@ class ActionPredictor(QtCore.QRunnable):
             # Selecting last 1s of signal
             X = X[np.newaxis, :, -int(self.fs*self.select_last_s):]
 
-            self.action_idx = predict(X, self.model, self.is_convnet,
-                                      self.n_crops, self.crop_len, self.fs,
-                                      self.should_reref, self.should_filter,
-                                      self.should_standardize)
+            # Specialize predict once (traced ConvNet input shape is fixed)
+            if self.predict_fn is None:
+                self.predict_fn = make_predict_fn(self.model, self.is_convnet,
+                                                  X.shape[1], self.n_crops,
+                                                  self.crop_len, self.fs,
+                                                  self.should_reref,
+                                                  self.should_filter,
+                                                  self.should_standardize,
+                                                  reduce_per_trial=False,
+                                                  sos=self.sos)
+            self.action_idx = self.predict_fn(X)
         logging.info(f'Action idx: {self.action_idx}')
 
         # Send action to avatar (if game is on + not rest command)
@@ -83,19 +83,16 @@ class CSP(BaseEstimator, TransformerMixin):
         n_csp = self.n_csp
 
         # Apply spatial transformation to input signal using the previously computed CSP filters
-        X_transformed = np.array([self.w.T @ X[trial_idx]
-                                  for trial_idx in range(X.shape[0])])
+        # (batched over trials, the reduction runs along the contiguous temporal axis)
+        X_transformed = np.matmul(self.w.T, X)
         assert X_transformed.shape == (n_trials, n_csp, n_samples)
 
         # Compute variance of each row of the CSP-transformed signal (apply on temporal axis)
-        variances = np.array([X_transformed[trial_idx] @ X_transformed[trial_idx].T
-                              for trial_idx in range(n_trials)])
-        assert variances.shape == (n_trials, n_csp, n_csp)
+        variances = np.einsum('ijk,ijk->ij', X_transformed, X_transformed)
+        assert variances.shape == (n_trials, n_csp)
 
         # Compute normalized log-variance features
-        feats = np.array([np.log10(np.diag(variances[trial_idx]) /
-                                   np.trace(variances[trial_idx]))
-                          for trial_idx in range(n_trials)])
+        feats = np.log10(variances / np.sum(variances, axis=1, keepdims=True))
         assert feats.shape == (n_trials, n_csp)
 
         return feats
@@ -140,9 +140,9 @@ class Riemann:
             X_filt = filtering(X, fs=self.fs, f_order=self.f_order,
                                f_low=f_band[0], f_high=f_band[1], f_type=self.f_type)
 
-            # Compute covariance matrices (regularized version)
-            cov_matrices = np.array([(1/(n_samples-1))*np.dot(X_t, X_t.T) + (
-                self.rho / n_samples)*np.eye(n_channels) for X_t in X_filt])
+            # Compute covariance matrices (regularized version, batched over trials)
+            cov_matrices = (1/(n_samples-1))*np.matmul(X_filt, X_filt.transpose(0, 2, 1)) + (
+                self.rho / n_samples)*np.eye(n_channels)
 
             # Project in tangent space w.r.t C_ref
             c_ref_invsqrt = self.C_ref_invsqrt[band_idx]
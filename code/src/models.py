@@ -1,6 +1,8 @@
-from collections import Counter
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import tensorflow as tf
 from sklearn.pipeline import Pipeline
 from sklearn.svm import SVC
 from tensorflow.keras.wrappers.scikit_learn import KerasClassifier
@@ -9,7 +11,7 @@ from .feature_extraction_functions.csp import CSP
 from .feature_extraction_functions.fbcsp import FBCSP
 from .feature_extraction_functions.riemann import Riemann
 from .feature_extraction_functions.convnets import ShallowConvNet
-from .preprocessing import cropping, preprocessing
+from .preprocessing import cropping, crop_preprocessing, get_preprocessing_sos
 
 # Reproducibility
 seed_value = 0
@@ -67,35 +69,154 @@ def get_ConvNet_model():
     return model, search_space
 
 
-def predict(X, models, is_convnet, n_crops=10, crop_len=0.5, fs=500, should_reref=True, should_filter=False, should_standardize=True):
-    """Return prediction of a trained model given input EEG data.
+def make_predict_fn(models, is_convnet, n_channels, n_crops=10, crop_len=0.5, fs=500, should_reref=True, should_filter=False, should_standardize=True, reduce_per_trial=False, sos=None):
+    """Return a predict function specialized for fixed models and settings.
 
-    Arguments:htop
-        X {np.array} -- EEG array of shape (n_trials, n_channels, n_samples)
+    Filter coefficients and traced ConvNets are resolved once, the returned
+    function only takes the EEG data.
+
+    Arguments:
         models {List[object]} -- Trained model
         is_convnet {bool} -- Model is convNet
+        n_channels {int} -- Number of input channels
+
+    Keyword Arguments:
+        reduce_per_trial {bool} -- Return one prediction per trial instead of
+        a single vote over all crops (default: {False})
+        sos {np.array} -- Precomputed filter coefficients, designed from fs
+        if None (default: {None})
 
     Returns:
-        np.array -- Array of predictions
+        function -- Maps an EEG array of shape (n_trials, n_channels, n_samples)
+        to its prediction(s)
     """
     if not isinstance(models, list):
         models = [models]
 
-    # Cropping
-    X, _ = cropping(X, [None], fs, n_crops, crop_len)
-
     if is_convnet:
-        # Preprocess
-        X = preprocessing(X, fs, should_reref,
-                          should_filter, should_standardize)
-
-        # ConvNet case - Adapt input shape & convert probabilities to int
-        y_prob = [model.predict(X[:, :, :, np.newaxis])
-                  for model in models]
-        y_probs = np.sum(y_prob, axis=0)
-        y_preds = np.argmax(y_probs, axis=1)
+        if should_filter and sos is None:
+            sos = get_preprocessing_sos(fs)
+        inference_fns = [get_inference_fn(model, n_channels, int(crop_len * fs))
+                         for model in models]
+
+        # Ensemble members run in parallel threads (one pool per function)
+        executor = ThreadPoolExecutor(len(inference_fns)) \
+            if len(inference_fns) > 1 else None
+
+        def predict_fn(X):
+            n_trials = X.shape[0]
+
+            # Crop & preprocess in a single pass
+            X = crop_preprocessing(np.ascontiguousarray(X, dtype=np.float32),
+                                   fs, n_crops, crop_len, should_reref,
+                                   should_filter, should_standardize, sos)
+
+            # ConvNet case - Adapt input shape & convert probabilities to int
+            X = X[:, :, :, np.newaxis]
+            if executor is None:
+                y_probs = predict_proba(inference_fns[0], X)
+            else:
+                y_prob = list(executor.map(
+                    lambda inference_fn: predict_proba(inference_fn, X),
+                    inference_fns))
+                y_probs = np.sum(y_prob, axis=0)
+
+            if reduce_per_trial:
+                # Sum crop probabilities of each trial
+                y_probs = y_probs.reshape(n_trials, n_crops, -1).sum(axis=1)
+                return np.argmax(y_probs, axis=1)
+            return int(majority_vote(np.argmax(y_probs, axis=1)[np.newaxis])[0])
     else:
-        y_preds = np.concatenate([model.predict(X) for model in models])
+        def predict_fn(X):
+            n_trials = X.shape[0]
+            X, _ = cropping(np.ascontiguousarray(X, dtype=np.float32),
+                            [None] * n_trials, fs, n_crops, crop_len)
+            y_preds = np.stack([model.predict(X) for model in models])
+
+            if reduce_per_trial:
+                # Majority vote over the crops of each trial (all models)
+                y_preds = y_preds.reshape(len(models), n_trials, n_crops)
+                return majority_vote(y_preds.transpose(1, 0, 2).reshape(n_trials, -1))
+            return int(majority_vote(y_preds.reshape(1, -1))[0])
+
+    return predict_fn
+
+
+# Traced forward passes per loaded ConvNet and input shape, released along
+# with the model (weak keys)
+_inference_fns = weakref.WeakKeyDictionary()
+
+
+def get_inference_fn(model, n_channels, n_samples):
+    """Return a traced (XLA compiled) forward pass of a Keras model.
+
+    Traces are cached per model and input shape, so rebuilding a predict
+    function (see make_predict_fn) does not retrace a loaded model.
+
+    Arguments:
+        model {tf.keras.Model} -- Trained ConvNet
+        n_channels {int} -- Number of input channels
+        n_samples {int} -- Number of input time samples
+
+    Returns:
+        tf.function -- Function mapping a float32 batch to probabilities
+    """
+    model_fns = _inference_fns.setdefault(model, {})
+    if (n_channels, n_samples) not in model_fns:
+        # Weak reference, the cached trace must not keep its key alive
+        model_ref = weakref.ref(model)
 
-    y_pred = Counter(y_preds).most_common()[0][0]
-    return y_pred
+        @tf.function(input_signature=[tf.TensorSpec([None, n_channels, n_samples, 1],
+                                                    tf.float32)],
+                     experimental_compile=True)
+        def inference_fn(x):
+            return model_ref()(x, training=False)
+        model_fns[(n_channels, n_samples)] = inference_fn
+    return model_fns[(n_channels, n_samples)]
+
+
+def predict_proba(inference_fn, X, batch_size=256):
+    """Return class probabilities of a traced ConvNet forward pass.
+
+    The last batch is zero-padded to batch_size so that XLA compiles a
+    single batch shape.
+
+    Arguments:
+        inference_fn {tf.function} -- Forward pass (see get_inference_fn)
+        X {np.array} -- float32 array of shape (n_trials, n_channels, n_samples, 1)
+
+    Keyword Arguments:
+        batch_size {int} -- Number of trials per forward pass (default: {256})
+
+    Returns:
+        np.array -- Array of shape (n_trials, n_classes)
+    """
+    y_probs = []
+    for i in range(0, len(X), batch_size):
+        X_batch = X[i:i + batch_size]
+        n_batch = len(X_batch)
+        if n_batch < batch_size:
+            X_batch = np.pad(X_batch, [(0, batch_size - n_batch)]
+                             + [(0, 0)] * (X.ndim - 1))
+        y_probs.append(inference_fn(tf.constant(X_batch)).numpy()[:n_batch])
+    return np.concatenate(y_probs)
+
+
+def majority_vote(y_votes):
+    """Return the most voted label of each row (smallest label on ties).
+
+    Arguments:
+        y_votes {np.array} -- Integer labels of shape (n_trials, n_votes)
+
+    Returns:
+        np.array -- Array of shape (n_trials,)
+    """
+    y_votes = np.asarray(y_votes, dtype=np.intp)
+    n_trials = y_votes.shape[0]
+    n_labels = y_votes.max() + 1
+
+    # Offset the labels of each row to count all rows in a single bincount
+    offsets = n_labels * np.arange(n_trials)[:, np.newaxis]
+    counts = np.bincount((y_votes + offsets).ravel(),
+                         minlength=n_trials * n_labels)
+    return np.argmax(counts.reshape(n_trials, n_labels), axis=1)
@@ -1,18 +1,20 @@
 import numpy as np
 import scipy.signal
+from numba import njit, prange
 from sklearn.base import BaseEstimator, TransformerMixin
 
 from config import train_config
 
 
-def preprocessing(signal, fs, rereference=False, filt=False, standardize=False):
+def preprocessing(signal, fs, rereference=False, filt=False, standardize=False, sos=None):
     if rereference:
         signal = rereferencing(signal)
     if filt:
         signal = filtering(signal, fs,
                            f_order=train_config['f_order'],
                            f_low=train_config['f_low'],
-                           f_high=train_config['f_high'])
+                           f_high=train_config['f_high'],
+                           sos=sos)
     if standardize:
         signal = clipping(signal, sigma=6)
         signal = standardizing(signal)
@@ -107,15 +109,51 @@ class BandPassFilter(BaseEstimator, TransformerMixin):
 
 def rereferencing(X):
     ''' Apply Common Average Reference to the signal. At each timestep the sum of all channel values should be zero. '''
-    average_channels = np.mean(X, axis=-2, keepdims=True)
-    return X - average_channels
+    X = np.ascontiguousarray(X)
+    X_trials = X.reshape((-1,) + X.shape[-2:])
+    return _rereference_trials(X_trials).reshape(X.shape)
+
+
+@njit(cache=True, parallel=True)
+def _rereference_trials(X):
+    n_trials, n_channels, n_samples = X.shape
+    X_reref = np.empty_like(X)
+    for trial_idx in prange(n_trials):
+        average_channels = np.zeros(n_samples)
+        for channel_idx in range(n_channels):
+            average_channels += X[trial_idx, channel_idx]
+        average_channels /= n_channels
+        for channel_idx in range(n_channels):
+            X_reref[trial_idx, channel_idx] = X[trial_idx, channel_idx] - \
+                average_channels
+    return X_reref
 
 
 def standardizing(X, eps=1e-8):
     ''' Outputs the standardized signal (zero mean, unit variance).'''
-    mean = np.mean(X, axis=-1, keepdims=True)
-    std = np.std(X, axis=-1, keepdims=True)
-    return (X-mean)/(std+eps)
+    X = np.ascontiguousarray(X)
+    X_rows = X.reshape(-1, X.shape[-1])
+    return _standardize_rows(X_rows, eps).reshape(X.shape)
+
+
+@njit(cache=True, parallel=True)
+def _standardize_rows(X, eps):
+    n_rows, n_samples = X.shape
+    X_std = np.empty_like(X)
+    for row_idx in prange(n_rows):
+        mean = 0.
+        for i in range(n_samples):
+            mean += X[row_idx, i]
+        mean /= n_samples
+
+        var = 0.
+        for i in range(n_samples):
+            var += (X[row_idx, i] - mean) ** 2
+        std = np.sqrt(var / n_samples)
+
+        for i in range(n_samples):
+            X_std[row_idx, i] = (X[row_idx, i] - mean) / (std + eps)
+    return X_std
 
 
 def perturbate(X, sigma):
@@ -124,8 +162,16 @@ def perturbate(X, sigma):
     return X + noise
 
 
-def filtering(X, fs=250, f_order=5, f_type='butter', f_low=4, f_high=38):
-    ''' Apply filtering operation on the input data using Second-order sections (sos) representation of the IIR filter (to avoid numerical instabilities).'''
+def filtering(X, fs=250, f_order=5, f_type='butter', f_low=4, f_high=38, sos=None):
+    ''' Apply filtering operation on the input data using Second-order sections (sos) representation of the IIR filter (to avoid numerical instabilities). Precomputed sos coefficients skip the filter design.'''
+    if sos is None:
+        sos = filter_design(fs, f_order, f_type, f_low, f_high)
+    X_bandpassed = scipy.signal.sosfilt(sos, X)
+    return X_bandpassed
+
+
+def filter_design(fs=250, f_order=5, f_type='butter', f_low=4, f_high=38):
+    ''' Outputs the second-order sections (sos) coefficients of the IIR filter, array of shape (n_sections, 6).'''
 
     filt_params = {'N': f_order,
                    'output': 'sos',
@@ -153,9 +199,14 @@ def filtering(X, fs=250, f_order=5, f_type='butter', f_low=4, f_high=38):
     else:
         filt_params['Wn'] = [f_low, f_high]
         sos = filt(**filt_params, btype='bandpass')
+    return sos
 
-    X_bandpassed = scipy.signal.sosfilt(sos, X)
-    return X_bandpassed
+
+def get_preprocessing_sos(fs):
+    ''' Outputs the sos coefficients of the band-pass filter applied by preprocessing (see train_config).'''
+    return filter_design(fs, f_order=train_config['f_order'],
+                         f_low=train_config['f_low'],
+                         f_high=train_config['f_high'])
 
 
 def clipping(X, sigma):
@@ -190,20 +241,45 @@ def clipping(X, sigma):
     return X_clipped
 
 
-def crop_single_trial(x, stride, n_samples, n_crops):
-    """Crop a single trial into n_crops of size crop_len.
+def epoching(X, end_idx, n_samples):
+    """Extract the epochs of n_samples ending at each given index.
 
     Arguments:
-        x {np.array} -- EEG data of shape (n_channels, n_samples)
+        X {np.array} -- EEG data of shape (n_channels, n_total_samples)
+        end_idx {np.array} -- Epoch end indices (excluded)
+        n_samples {int} -- Time samples of each epoch
 
-    Keyword Arguments:
+    Returns:
+        np.array -- Epochs of shape (n_epochs, n_channels, n_samples)
+    """
+    end_idx = np.asarray(end_idx)
+    assert np.all(end_idx >= n_samples), 'Epoch starts before the signal !'
+
+    # Strided view over all windows (no copy), gathered once
+    n_channels, n_total_samples = X.shape
+    windows = np.lib.stride_tricks.as_strided(
+        X, shape=(n_channels, n_total_samples - n_samples + 1, n_samples),
+        strides=(X.strides[0], X.strides[1], X.strides[1]), writeable=False)
+    return np.ascontiguousarray(windows[:, end_idx - n_samples].transpose(1, 0, 2))
+
+
+@njit(cache=True, parallel=True)
+def _crop_trials(X, stride, n_samples, n_crops):
+    """Crop each trial into n_crops of n_samples (trial-major order).
+
+    Arguments:
+        X {np.array} -- EEG data of shape (n_trials, n_channels, n_total_samples)
         stride {int} -- Interval between starts of two consecutive crops in samples.
         n_samples {int} -- Time sample for each output crop.
-        n_crops {int} -- Number of desired output crops.
+        n_crops {int} -- Number of desired output crops per trial.
     """
-    assert stride > 0, 'Stride should be positive !'
-    X_crops = np.stack([x[:, i*stride: i*stride + n_samples]
-                        for i in range(n_crops)], axis=0)
+    n_trials, n_channels, _ = X.shape
+    X_crops = np.empty((n_trials * n_crops, n_channels, n_samples),
+                       dtype=X.dtype)
+    for crop_idx in prange(n_trials * n_crops):
+        trial_idx = crop_idx // n_crops
+        start = (crop_idx % n_crops) * stride
+        X_crops[crop_idx] = X[trial_idx, :, start:start + n_samples]
     return X_crops
 
 
@@ -213,11 +289,102 @@ def cropping(X, y, fs=500, n_crops=50, crop_len=0.5):
     # Cropping parameters
     n_samples = int(crop_len * fs)  # samples
     stride = int((X.shape[-1] - n_samples) / (n_crops - 1))  # samples
-    overlap_ratio = 1 - stride / n_samples
+    assert stride > 0, 'Stride should be positive !'
 
-    X_crops = np.concatenate([crop_single_trial(x, stride, n_samples, n_crops)
-                              for x in X], axis=0)
+    X_crops = _crop_trials(np.ascontiguousarray(X), stride, n_samples, n_crops)
     y_crops = np.concatenate([[y[trial_idx]] * n_crops
                               for trial_idx in range(len(y))])
 
     return X_crops, y_crops
+
+
+def crop_preprocessing(X, fs=500, n_crops=50, crop_len=0.5, rereference=False, filt=False, standardize=False, sos=None):
+    """Crop each trial and preprocess the crops in a single pass.
+
+    Same output as preprocessing(cropping(X)) but each crop is rereferenced,
+    filtered, clipped and standardized while it stays in cache.
+
+    Arguments:
+        X {np.array} -- EEG data of shape (n_trials, n_channels, n_total_samples)
+
+    Keyword Arguments:
+        sos {np.array} -- Precomputed filter coefficients, designed from
+        train_config if None (default: {None})
+
+    Returns:
+        np.array -- Crops of shape (n_trials * n_crops, n_channels, n_samples)
+    """
+    assert n_crops > 1, 'Use n_crops > 1 !'
+
+    # Cropping parameters
+    n_samples = int(crop_len * fs)  # samples
+    stride = int((X.shape[-1] - n_samples) / (n_crops - 1))  # samples
+    assert stride > 0, 'Stride should be positive !'
+
+    if not filt:
+        sos = np.empty((0, 6))
+    elif sos is None:
+        sos = get_preprocessing_sos(fs)
+
+    return _crop_preprocess_trials(np.ascontiguousarray(X), stride, n_samples,
+                                   n_crops, rereference, sos, standardize,
+                                   6, 1e-8)
+
+
+@njit(cache=True, parallel=True)
+def _crop_preprocess_trials(X, stride, n_samples, n_crops, rereference, sos, standardize, sigma, eps):
+    n_trials, n_channels, _ = X.shape
+    n_sections = sos.shape[0]
+    X_crops = np.empty((n_trials * n_crops, n_channels, n_samples),
+                       dtype=X.dtype)
+
+    for crop_idx in prange(n_trials * n_crops):
+        trial_idx = crop_idx // n_crops
+        start = (crop_idx % n_crops) * stride
+        crop = np.empty((n_channels, n_samples))
+        crop[:, :] = X[trial_idx, :, start:start + n_samples]
+
+        # Common average reference
+        if rereference:
+            average_channels = np.zeros(n_samples)
+            for channel_idx in range(n_channels):
+                average_channels += crop[channel_idx]
+            average_channels /= n_channels
+            for channel_idx in range(n_channels):
+                crop[channel_idx] -= average_channels
+
+        for channel_idx in range(n_channels):
+            x = crop[channel_idx]
+
+            # IIR filtering (cascaded biquads, direct form II transposed)
+            for section_idx in range(n_sections):
+                b0, b1, b2 = sos[section_idx, 0], sos[section_idx, 1], sos[section_idx, 2]
+                a1, a2 = sos[section_idx, 4], sos[section_idx, 5]
+                z1 = 0.
+                z2 = 0.
+                for i in range(n_samples):
+                    y = b0 * x[i] + z1
+                    z1 = b1 * x[i] - a1 * y + z2
+                    z2 = b2 * x[i] - a2 * y
+                    x[i] = y
+
+            if standardize:
+                # Clipping (+-sigma*std around the median)
+                std = np.std(x)
+                median = np.median(x)
+                top = median + sigma * std
+                bottom = median - sigma * std
+                for i in range(n_samples):
+                    if x[i] > top:
+                        x[i] = top
+                    elif x[i] < bottom:
+                        x[i] = bottom
+
+                # Standardizing
+                mean = np.mean(x)
+                std = np.std(x)
+                for i in range(n_samples):
+                    x[i] = (x[i] - mean) / (std + eps)
+
+            X_crops[crop_idx, channel_idx] = x
+    return X_crops